@@ -1,38 +1,157 @@
+import asyncio
 import base64
+import functools
+import hashlib
 import logging
 import os
+from collections.abc import Awaitable, Callable
 from io import BytesIO
-from typing import Any, BinaryIO
+from typing import Any
 
+import httpx
+import orjson
+from cachetools import TTLCache
 from fastapi import HTTPException
-from openai import OpenAI
+from openai import (
+    APIConnectionError,
+    AsyncOpenAI,
+    DefaultAsyncHttpxClient,
+    InternalServerError,
+    RateLimitError,
+)
+from PIL import Image, ImageOps
+from tenacity import (
+    AsyncRetrying,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
 
 # Set up detailed logging for the AI service
 logger = logging.getLogger(__name__)
 
-# Initialize OpenAI client if API key is available
-# This allows for easier mocking in tests
-if os.getenv("OPENAI_API_KEY"):
-    logger.info("Initializing OpenAI client with API key")
-    client = OpenAI()
-else:
+# Maximum number of OpenAI calls in flight at once, across all requests
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+
+# The OpenAI client is created on first use rather than at import, so tests and
+# reloads that never call OpenAI don't pay for setting up its HTTP client
+client: AsyncOpenAI | None = None
+http_client: httpx.AsyncClient | None = None
+
+if not os.getenv("OPENAI_API_KEY"):
     logger.warning(
         "OPENAI_API_KEY environment variable not set, AI features will be mocked"
     )
-    client = None
 
 
-async def generate_profile_images(
-    image_data: BinaryIO | bytes, num_variants: int
-) -> list[bytes]:
+def get_client() -> AsyncOpenAI | None:
+    """Get the shared OpenAI client, creating it on first use
+
+    Returns:
+        The OpenAI client, or None if the OPENAI_API_KEY environment variable
+        isn't set
+    """
+    global client, http_client
+    if client is None and os.getenv("OPENAI_API_KEY"):
+        logger.info("Initializing OpenAI client with API key")
+        # DALL-E 3 only accepts one prompt and one image per request, so instead
+        # of batching, keep warm connections around for every call we allow in
+        # flight. HTTP/2 lets the concurrent calls share a connection where
+        # possible. The same connections are used to download generated images.
+        http_client = DefaultAsyncHttpxClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONCURRENCY,
+                max_keepalive_connections=OPENAI_MAX_CONCURRENCY,
+            ),
+            timeout=httpx.Timeout(60.0, connect=10.0),
+        )
+        client = AsyncOpenAI(
+            http_client=http_client,
+            # Retries are handled by call_openai so they don't hold the semaphore
+            max_retries=0,
+        )
+    return client
+
+
+async def close_client() -> None:
+    """Close the OpenAI client's HTTP connections, if there is a client"""
+    global client, http_client
+    if client is not None:
+        logger.info("Closing OpenAI client")
+        await client.close()
+        client = None
+        http_client = None
+
+
+# Cap the number of in-flight OpenAI calls across all requests so bursts of
+# traffic are throttled here instead of being rejected by the rate limiter
+openai_semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+
+# How long to wait between attempts at an OpenAI call that failed transiently
+openai_retry_wait = wait_random_exponential(min=1, max=20)
+
+
+async def call_openai[**P, T](
+    request: Callable[P, Awaitable[T]], *args: P.args, **kwargs: P.kwargs
+) -> T:
+    """Make an OpenAI request under the concurrency cap, retrying transient errors
+
+    Rate limits, connection errors, and 5xx errors are retried with jittered
+    exponential backoff, releasing the semaphore while waiting. Other errors
+    are raised immediately, as is the last error once we give up.
+
+    Args:
+        request: OpenAI client method to call
+        *args: Positional arguments for the request
+        **kwargs: Keyword arguments for the request
+
+    Returns:
+        The response from OpenAI
+    """
+
+    async def attempt() -> T:
+        async with openai_semaphore:
+            return await request(*args, **kwargs)
+
+    retrying = AsyncRetrying(
+        retry=retry_if_exception_type(
+            (RateLimitError, APIConnectionError, InternalServerError)
+        ),
+        stop=stop_after_attempt(3),
+        wait=openai_retry_wait,
+        reraise=True,
+    )
+    return await retrying(attempt)
+
+
+# Longest side, in pixels, of the copy of the upload that is sent to GPT-4o
+ANALYSIS_IMAGE_MAX_SIZE = 1024
+
+# Uploads with more pixels than this are sent to GPT-4o as-is rather than
+# decoded, since a small compressed file can expand to gigabytes in memory
+ANALYSIS_IMAGE_MAX_PIXELS = 50_000_000
+
+# Remember the GPT-4o prompts for recently uploaded images so re-uploading the
+# same photo skips the analysis step. This is kept in memory only and expires.
+prompt_cache = TTLCache[str, list[str]](maxsize=1024, ttl=3600)
+
+
+def _prompt_cache_key(image_bytes: bytes, num_variants: int) -> str:
+    """Build the prompt cache key from a hash of the image and the variant count"""
+    digest = hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+    return f"{digest}:{num_variants}"
+
+
+async def generate_profile_images(image_data: bytes, num_variants: int) -> list[bytes]:
     """Generate profile image variants using OpenAI's GPT-4o and DALL-E 3 models
 
     This uses a two-step approach:
     1. GPT-4o analyzes the image and creates detailed prompts
-    2. DALL-E 3 generates profile pictures based on those prompts
+    2. DALL-E 3 generates profile pictures based on those prompts, concurrently
 
     Args:
-        image_data: Binary image data from user upload, either as bytes or file-like object
+        image_data: Binary image data from user upload
         num_variants: Number of variants to generate
 
     Returns:
@@ -40,31 +159,37 @@ async def generate_profile_images(
     """
     try:
         # If client is None (e.g., no API key), return dummy data for testing
-        if client is None:
+        if get_client() is None:
             logger.warning("OpenAI client not initialized, returning dummy data")
             return [b"" for _ in range(num_variants)]
 
-        # Convert to BytesIO if we got raw bytes
-        if isinstance(image_data, bytes):
-            image_data = BytesIO(image_data)
-
-        # Create a list to store the generated images
-        results: list[bytes] = []
+        cache_key = _prompt_cache_key(image_data, num_variants)
 
         # Step 1: Analyze the image with GPT-4o to create prompts
-        prompts = await analyze_image_with_gpt4o(image_data, num_variants)
+        cached_prompts = prompt_cache.get(cache_key)
+        if cached_prompts is not None:
+            logger.info("Using cached prompts for previously analyzed image")
+            prompts = cached_prompts
+        else:
+            prompts = await analyze_image_with_gpt4o(image_data, num_variants)
+            prompt_cache[cache_key] = prompts
 
-        # Step 2: Generate images with DALL-E 3 using the prompts
+        # Step 2: Generate images with DALL-E 3 concurrently using the prompts
         for i, prompt in enumerate(prompts):
-            try:
-                logger.info(f"Generating variant {i + 1} with prompt: {prompt}")
-                # Generate an image with DALL-E 3
-                image_bytes = await generate_image_with_dalle(prompt)
-                results.append(image_bytes)
-            except Exception as e:
-                logger.warning(f"Error generating variant {i + 1}: {str(e)}")
-                # Add empty data for this failed variant
+            logger.info(f"Generating variant {i + 1} with prompt: {prompt}")
+        raw_results = await asyncio.gather(
+            *(generate_image_with_dalle(prompt) for prompt in prompts),
+            return_exceptions=True,
+        )
+
+        # Add empty data for any failed variants
+        results: list[bytes] = []
+        for i, result in enumerate(raw_results):
+            if isinstance(result, BaseException):
+                logger.warning(f"Error generating variant {i + 1}: {str(result)}")
                 results.append(b"")
+            else:
+                results.append(result)
 
         # If we generated too many variants, truncate the list
         if len(results) > num_variants:
@@ -86,43 +211,68 @@ async def generate_profile_images(
         raise
 
 
-async def analyze_image_with_gpt4o(
-    image_data: BytesIO | BinaryIO, num_variants: int
-) -> list[str]:
-    """Analyze image with GPT-4o and generate prompts for DALL-E 3
+def _prepare_image_for_analysis(image_bytes: bytes) -> bytes:
+    """Downscale and re-encode an image as JPEG before sending it to GPT-4o
+
+    GPT-4o downsamples large images anyway, so this only cuts upload size and
+    input tokens. If Pillow can't decode the image, or it has more than
+    ANALYSIS_IMAGE_MAX_PIXELS pixels, the original bytes are used.
 
     Args:
-        image_data: Image data to analyze
-        num_variants: Number of prompt variants to generate
+        image_bytes: Image data from user upload
 
     Returns:
-        List of prompts for DALL-E 3
+        JPEG image data no larger than ANALYSIS_IMAGE_MAX_SIZE on either side
     """
-    # Reset file pointer
-    image_data.seek(0)
-
-    # Encode image to base64
-    base64_image = base64.b64encode(image_data.read()).decode("utf-8")
+    try:
+        with Image.open(BytesIO(image_bytes)) as image:
+            # Opening only reads the header, so check the size before decoding
+            if image.width * image.height > ANALYSIS_IMAGE_MAX_PIXELS:
+                logger.warning(
+                    f"Image is {image.width}x{image.height} pixels, sending it as-is"
+                )
+                return image_bytes
+            # Thumbnail first so JPEGs can be decoded at reduced size
+            image.thumbnail((ANALYSIS_IMAGE_MAX_SIZE, ANALYSIS_IMAGE_MAX_SIZE))
+            image = ImageOps.exif_transpose(image)
+            buffer = BytesIO()
+            image.convert("RGB").save(buffer, "JPEG", quality=85, optimize=True)
+            return buffer.getvalue()
+    except (OSError, Image.DecompressionBombError) as e:
+        logger.warning(f"Could not downscale image, sending it as-is: {str(e)}")
+        return image_bytes
+
+
+# Profile picture styles to ask GPT-4o for, one per variant
+PROFESSIONAL_STYLES = (
+    "Corporate/formal - Business attire, neutral background, professional lighting",
+    "Creative professional - Modern setting, creative lighting, artistic composition",
+    "Friendly but professional - Warm colors, approachable pose, soft lighting",
+    "Modern minimalist - Clean background, minimalist composition, subtle tones",
+    "Executive portrait - Power pose, premium setting, sophisticated lighting",
+    "Tech professional - Modern office setting, blue tones, technology-themed",
+    "Outdoor professional - Natural light, outdoor business setting, organic feel",
+    "Studio portrait - Professional studio lighting, perfect composition, timeless",
+)
+
+
+@functools.lru_cache(maxsize=16)
+def _system_message(num_variants: int) -> str:
+    """Build the GPT-4o system message for the requested number of variants
 
-    # Create system message with instructions, adjusted for the requested number of variants
-    professional_styles = [
-        "Corporate/formal - Business attire, neutral background, professional lighting",
-        "Creative professional - Modern setting, creative lighting, artistic composition",
-        "Friendly but professional - Warm colors, approachable pose, soft lighting",
-        "Modern minimalist - Clean background, minimalist composition, subtle tones",
-        "Executive portrait - Power pose, premium setting, sophisticated lighting",
-        "Tech professional - Modern office setting, blue tones, technology-themed",
-        "Outdoor professional - Natural light, outdoor business setting, organic feel",
-        "Studio portrait - Professional studio lighting, perfect composition, timeless",
-    ]
+    Args:
+        num_variants: Number of prompt variants to ask for
 
+    Returns:
+        System message with instructions and the styles to use
+    """
     # Select the appropriate number of style descriptions based on num_variants
-    style_descriptions = professional_styles[:num_variants]
+    style_descriptions = PROFESSIONAL_STYLES[:num_variants]
     style_bullet_points = "\n".join(
         [f"       - {style}" for style in style_descriptions]
     )
 
-    system_message = f"""
+    return f"""
     You are an expert at analyzing photos and creating detailed prompts for DALL-E 3 to generate professional profile pictures.
 
     Your task:
@@ -150,24 +300,45 @@ async def analyze_image_with_gpt4o(
     - Include lighting, composition, and background suggestions
     """
 
+
+async def analyze_image_with_gpt4o(image_bytes: bytes, num_variants: int) -> list[str]:
+    """Analyze image with GPT-4o and generate prompts for DALL-E 3
+
+    Args:
+        image_bytes: Image data to analyze
+        num_variants: Number of prompt variants to generate
+
+    Returns:
+        List of prompts for DALL-E 3
+    """
+    # If client is None (e.g., no API key), return dummy data before doing any
+    # work on the image, since the dummy prompts don't depend on it
+    openai_client = get_client()
+    if openai_client is None:
+        logger.warning("OpenAI client not initialized for analyze_image_with_gpt4o")
+        # Use our predefined styles for dummy prompts when possible
+        return [
+            f"Professional headshot in {PROFESSIONAL_STYLES[i % len(PROFESSIONAL_STYLES)]} style"
+            for i in range(num_variants)
+        ]
+
+    # Shrink the image off the event loop, then encode it to base64
+    analysis_image = await asyncio.to_thread(_prepare_image_for_analysis, image_bytes)
+    base64_image = base64.b64encode(analysis_image).decode("ascii")
+
+    # Create system message with instructions, adjusted for the requested number of variants
+    system_message = _system_message(num_variants)
+
     # Create user message with the image
     user_message = (
         "Create detailed prompts for professional profile pictures based on this photo"
     )
 
     try:
-        # If client is None (e.g., no API key), return dummy data
-        if client is None:
-            logger.warning("OpenAI client not initialized for analyze_image_with_gpt4o")
-            # Use our predefined styles for dummy prompts when possible
-            return [
-                f"Professional headshot in {professional_styles[i % len(professional_styles)]} style"
-                for i in range(num_variants)
-            ]
-
         # Call the GPT-4o API
         logger.info("Calling GPT-4o for image analysis")
-        response = client.chat.completions.create(
+        response = await call_openai(
+            openai_client.chat.completions.create,
             model="gpt-4o",
             messages=[
                 {"role": "system", "content": system_message},
@@ -190,8 +361,6 @@ async def analyze_image_with_gpt4o(
         logger.info("Received response from GPT-4o: %s", response)
 
         # Parse and extract prompts from the response
-        import json
-
         try:
             content = response.choices[0].message.content
             if not content:
@@ -199,7 +368,7 @@ async def analyze_image_with_gpt4o(
             logger.info(f"GPT-4o response content: {content}")
 
             # Parse JSON response
-            response_data: Any = json.loads(content)
+            response_data: Any = orjson.loads(content)
 
             # Extract prompts from the response
             raw_prompts: list[Any] = []
@@ -219,12 +388,12 @@ async def analyze_image_with_gpt4o(
                     f"Only received {len(prompts)} prompts, filling in the rest with generic ones"
                 )
                 for i in range(len(prompts), num_variants):
-                    style = professional_styles[i % len(professional_styles)]
+                    style = PROFESSIONAL_STYLES[i % len(PROFESSIONAL_STYLES)]
                     prompts.append(f"Professional headshot in {style} style")
 
             return prompts
 
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             logger.warning("Failed to parse JSON response from GPT-4o")
             raise
 
@@ -244,7 +413,8 @@ async def generate_image_with_dalle(prompt: str) -> bytes:
     """
     try:
         # If client is None (e.g., no API key), return dummy data
-        if client is None:
+        openai_client = get_client()
+        if openai_client is None or http_client is None:
             logger.warning(
                 "OpenAI client not initialized for generate_image_with_dalle"
             )
@@ -252,24 +422,24 @@ async def generate_image_with_dalle(prompt: str) -> bytes:
 
         # Call the DALL-E 3 API
         logger.info("Calling DALL-E 3 for image generation")
-        response = client.images.generate(
+        response = await call_openai(
+            openai_client.images.generate,
             model="dall-e-3",
             prompt=f"Create a professional profile picture with the following description: {prompt}",
             n=1,
             size="1024x1024",
-            response_format="b64_json",
+            response_format="url",
         )
         logger.info("Received response from DALL-E 3")
 
-        # Extract the image data
-        if (
-            response.data
-            and hasattr(response.data[0], "b64_json")
-            and response.data[0].b64_json
-        ):
-            return base64.b64decode(response.data[0].b64_json)
+        # Download the image bytes directly, rather than having DALL-E send them
+        # base64-encoded inside its JSON response
+        if response.data and response.data[0].url:
+            image_response = await http_client.get(response.data[0].url)
+            image_response.raise_for_status()
+            return image_response.content
         else:
-            logger.warning("No valid image data in DALL-E response")
+            logger.warning("No valid image URL in DALL-E response")
             return b""
 
     except Exception as e:
@@ -1,12 +1,18 @@
 import base64
+import functools
 import logging
+import secrets
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from pathlib import Path
 
+from cachetools import TTLCache
 from fastapi import FastAPI, HTTPException, UploadFile
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 
-from profileinator.ai_service import generate_profile_images
+from profileinator.ai_service import close_client, generate_profile_images
 
 # Set up logging for the main application
 logging.basicConfig(
@@ -14,34 +20,89 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Release the OpenAI client's connections when the server shuts down"""
+    yield
+    await close_client()
+
+
 app = FastAPI(
     title="Profileinator",
     description="Generate profile pictures using AI",
     version="0.1.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
 )
 
 # Mount static files directory
 app.mount("/static", StaticFiles(directory="profileinator/static"), name="static")
 
+# Largest image upload we accept, in bytes
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+
+# Generated images are kept in memory just long enough for the browser to load
+# them, bounded by their total size rather than the number of requests
+image_cache = TTLCache[str, list[bytes]](
+    maxsize=256 * 1024 * 1024,
+    ttl=600,
+    getsizeof=lambda images: sum(len(img) for img in images),
+)
+
+
+@functools.lru_cache(maxsize=1)
+def _index_html() -> str:
+    """Read the main page on first use and reuse it for every later request"""
+    return Path("profileinator/static/index.html").read_text()
+
 
 @app.get("/", response_class=HTMLResponse)
 async def read_root() -> str:
     """Serve the main page"""
     logger.info("Serving main page")
-    with open("profileinator/static/index.html") as file:
-        return file.read()
+    return _index_html()
 
 
 class ImageResponse(BaseModel):
+    # Image URLs, or base64-encoded images if requested with inline=true
     images: list[str]
     original_filename: str | None
 
 
+@app.get("/images/{request_id}/{index}")
+async def get_image(request_id: str, index: int) -> Response:
+    """Serve one of the generated images from a previous request"""
+    images = image_cache.get(request_id)
+    if images is None or not 0 <= index < len(images):
+        logger.warning(f"Image not found: {request_id}/{index}")
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    return Response(
+        content=images[index],
+        media_type="image/png",
+        headers={"Cache-Control": "private, max-age=600"},
+    )
+
+
+def _upload_too_large() -> HTTPException:
+    """Build the error for an upload over MAX_UPLOAD_BYTES"""
+    if MAX_UPLOAD_BYTES % (1024 * 1024) == 0:
+        limit = f"{MAX_UPLOAD_BYTES // (1024 * 1024)} MB"
+    else:
+        limit = f"{MAX_UPLOAD_BYTES} bytes"
+    return HTTPException(status_code=413, detail=f"Image must be at most {limit}")
+
+
 @app.post("/generate/", response_model=ImageResponse)
 async def generate_profiles(
-    image: UploadFile, num_variants: int
-) -> ImageResponse | JSONResponse:
-    """Generate profile pictures using AI based on uploaded image"""
+    image: UploadFile, num_variants: int, inline: bool = False
+) -> ImageResponse | ORJSONResponse:
+    """Generate profile pictures using AI based on uploaded image
+
+    The images are returned as URLs to fetch them from, so they don't have to
+    be base64-encoded into the response. Pass inline=true to get base64 instead.
+    """
     logger.info(f"Received image upload: {image.filename} with {num_variants} variants")
 
     # Validate file is an image
@@ -56,11 +117,18 @@ async def generate_profiles(
             status_code=400, detail="Number of variants must be between 1 and 10"
         )
 
-    try:
-        # Read the image file
-        image_data = await image.read()
-        logger.info(f"Read {len(image_data)} bytes from uploaded image")
+    # Read the image file, reading at most one byte past the limit so oversized
+    # uploads are never fully loaded into memory
+    if image.size is not None and image.size > MAX_UPLOAD_BYTES:
+        logger.warning(f"Upload too large: {image.size} bytes")
+        raise _upload_too_large()
+    image_data = await image.read(MAX_UPLOAD_BYTES + 1)
+    if len(image_data) > MAX_UPLOAD_BYTES:
+        logger.warning("Upload too large")
+        raise _upload_too_large()
+    logger.info(f"Read {len(image_data)} bytes from uploaded image")
 
+    try:
         # Generate profile images using the AI service
         logger.info(f"Starting profile image generation with {num_variants} variants")
         generated_images = await generate_profile_images(
@@ -68,26 +136,33 @@ async def generate_profiles(
         )
         logger.info(f"Generated {len(generated_images)} profile images")
 
-        # Convert binary image data to base64 strings for client-side display
-        base64_images: list[str] = []
-        for i, img in enumerate(generated_images):
-            if img:
-                encoded_img = base64.b64encode(img).decode("utf-8")
-                base64_images.append(encoded_img)
-                logger.info(f"Processed variant {i + 1}: {len(img)} bytes")
-            else:
-                placeholder = base64.b64encode(b"placeholder").decode("utf-8")
-                base64_images.append(placeholder)
-                logger.warning(f"Variant {i + 1} was empty, using placeholder")
+        # Fill in placeholders for any variants that failed to generate
+        images = [img or b"placeholder" for img in generated_images]
+        num_empty = sum(1 for img in generated_images if not img)
+        if num_empty:
+            logger.warning(f"{num_empty} variants were empty, using placeholders")
+        logger.info(
+            f"Processed {len(images)} variants, "
+            f"total {sum(len(img) for img in images)} bytes"
+        )
+
+        if inline:
+            # Convert binary image data to base64 strings for client-side display
+            image_strings = [base64.b64encode(img).decode("ascii") for img in images]
+        else:
+            # Keep the images in memory and let the client fetch them by URL
+            request_id = secrets.token_urlsafe(16)
+            image_cache[request_id] = images
+            image_strings = [f"/images/{request_id}/{i}" for i in range(len(images))]
 
         logger.info("Returning generated images to client")
         return ImageResponse(
-            images=base64_images,
+            images=image_strings,
             original_filename=image.filename,
         )
     except Exception as e:
         logger.error(f"Error processing image: {str(e)}", exc_info=True)
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=500,
             content={"detail": "Failed to generate profiles. Please try again."},
         )
@@ -23,12 +23,34 @@ def run_server() -> None:
     port = int(os.getenv("PORT", "8000"))
     logger.info(f"Server will run on port {port}")
 
-    # Start the server
+    # Only reload on code changes in development, since the file watcher is
+    # pure overhead in production and can't be combined with multiple workers
+    if os.getenv("DEV", "0") == "1":
+        logger.info("Running in development mode with auto-reload")
+        uvicorn.run(
+            "profileinator.main:app",
+            host="0.0.0.0",
+            port=port,
+            reload=True,
+            log_level="info",
+        )
+        return
+
+    # Generated images are cached in each worker's memory until the browser
+    # fetches them, so only add workers behind a load balancer with sticky
+    # sessions
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    logger.info(f"Server will run with {workers} worker(s)")
+
+    # Start the server. uvicorn[standard] installs uvloop and httptools, which
+    # uvicorn picks over asyncio and h11 wherever they're available.
     uvicorn.run(
         "profileinator.main:app",
         host="0.0.0.0",
         port=port,
-        reload=True,
+        workers=workers,
+        loop="auto",
+        http="auto",
         log_level="info",
     )
 
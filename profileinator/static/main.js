@@ -80,13 +80,13 @@ document.addEventListener('DOMContentLoaded', () => {
     function displayProfileImages(images) {
         profileImages.innerHTML = '';
         
-        images.forEach((imageData, index) => {
+        images.forEach((imageUrl, index) => {
             const card = document.createElement('div');
             card.className = 'profile-card';
             
             const img = document.createElement('img');
             img.className = 'profile-image';
-            img.src = `data:image/jpeg;base64,${imageData}`;
+            img.src = imageUrl;
             img.alt = `AI Generated Profile ${index + 1}`;
             
             const actions = document.createElement('div');
@@ -96,7 +96,7 @@ document.addEventListener('DOMContentLoaded', () => {
             downloadBtn.className = 'download-button';
             downloadBtn.textContent = 'Download';
             downloadBtn.addEventListener('click', () => {
-                downloadImage(imageData, `profile-${index + 1}.jpg`);
+                downloadImage(imageUrl, `profile-${index + 1}.png`);
             });
             
             actions.appendChild(downloadBtn);
@@ -107,9 +107,9 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     // Function to download an image
-    function downloadImage(base64Data, filename) {
+    function downloadImage(imageUrl, filename) {
         const link = document.createElement('a');
-        link.href = `data:image/jpeg;base64,${base64Data}`;
+        link.href = imageUrl;
         link.download = filename;
         document.body.appendChild(link);
         link.click();
@@ -0,0 +1,13 @@
+from collections.abc import Iterator
+
+import pytest
+from fastapi.testclient import TestClient
+
+from profileinator.main import app
+
+
+@pytest.fixture(scope="session")
+def client() -> Iterator[TestClient]:
+    """Fixture to share one test client, running the app's lifespan only once"""
+    with TestClient(app) as test_client:
+        yield test_client
@@ -1,57 +1,111 @@
+import asyncio
+import json
 from io import BytesIO
+from types import SimpleNamespace
 from typing import Any
 
+import httpx
 import pytest
+from openai import RateLimitError
+from PIL import Image
+from tenacity import wait_none
 
 from profileinator import ai_service
 from profileinator.ai_service import generate_profile_images
 
+# Dummy upload shared by the AI service tests (not a decodable image)
+MOCK_IMAGE = b"test image data"
 
-class MockChatCompletionResponse:
-    """Mock ChatCompletion response"""
+# Canned OpenAI responses, built once and shared by every mock call
+MOCK_PROMPTS = [f"Test prompt {i}" for i in range(1, 5)]
+MOCK_CHAT_RESPONSE = SimpleNamespace(
+    choices=[
+        SimpleNamespace(
+            message=SimpleNamespace(content=json.dumps({"prompt": MOCK_PROMPTS}))
+        )
+    ]
+)
+MOCK_IMAGES_RESPONSE = SimpleNamespace(
+    data=[SimpleNamespace(url="https://images.example.com/test.png")]
+)
 
-    class Message:
-        def __init__(self, content: str) -> None:
-            self.content = content
 
-    class Choice:
-        def __init__(self, content: str) -> None:
-            self.message = MockChatCompletionResponse.Message(content)
+class MockChatCompletions:
+    """Mock chat completions API"""
 
-    def __init__(self, content: str) -> None:
-        self.choices = [MockChatCompletionResponse.Choice(content)]
+    def __init__(self) -> None:
+        self.calls = 0
 
+    async def create(self, **kwargs: Any) -> SimpleNamespace:
+        """Mock create method"""
+        self.calls += 1
+        return MOCK_CHAT_RESPONSE
 
-class MockImageResponse:
-    """Mock image response item"""
 
-    def __init__(self) -> None:
-        self.b64_json: str = "test_base64data"
+class InFlightTracker:
+    """Records how many mock OpenAI calls are in flight at once
 
+    Each call waits until `expected` calls are in flight together, or until the
+    test sets `release` itself.
+    """
 
-class MockImageData:
-    """Mock images API response data"""
+    def __init__(self, expected: int) -> None:
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.expected = expected
+        self.release = asyncio.Event()
 
-    def __init__(self) -> None:
-        self.data: list[MockImageResponse] = [MockImageResponse()]
+    async def track(self) -> None:
+        """Count a call as in flight until it is released"""
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.in_flight >= self.expected:
+                self.release.set()
+            # Times out if the other calls never get in flight at the same time
+            await asyncio.wait_for(self.release.wait(), timeout=1)
+        finally:
+            self.in_flight -= 1
 
 
-class MockChatCompletions:
-    """Mock chat completions API"""
+class ConcurrencyTrackingChatCompletions(MockChatCompletions):
+    """Mock chat completions API that records how many calls are in flight at once"""
 
-    def create(self, **kwargs: Any) -> MockChatCompletionResponse:
-        """Mock create method"""
-        return MockChatCompletionResponse(
-            '{"prompts": ["Test prompt 1", "Test prompt 2", "Test prompt 3", "Test prompt 4"]}'
-        )
+    def __init__(self, tracker: InFlightTracker) -> None:
+        super().__init__()
+        self.tracker = tracker
+
+    async def create(self, **kwargs: Any) -> SimpleNamespace:
+        """Mock create method that waits for the tracker to release it"""
+        await self.tracker.track()
+        return await super().create(**kwargs)
 
 
 class MockImages:
     """Mock OpenAI images API"""
 
-    def generate(self, **kwargs: Any) -> MockImageData:
+    async def generate(self, **kwargs: Any) -> SimpleNamespace:
         """Mock generate method"""
-        return MockImageData()
+        return MOCK_IMAGES_RESPONSE
+
+
+class ConcurrencyTrackingImages(MockImages):
+    """Mock images API that records how many calls are in flight at once"""
+
+    def __init__(self, tracker: InFlightTracker) -> None:
+        self.tracker = tracker
+
+    async def generate(self, **kwargs: Any) -> SimpleNamespace:
+        """Mock generate method that waits for the tracker to release it"""
+        await self.tracker.track()
+        return await super().generate(**kwargs)
+
+
+class MockChat:
+    """Mock OpenAI chat API"""
+
+    def __init__(self) -> None:
+        self.completions = MockChatCompletions()
 
 
 class MockOpenAI:
@@ -59,63 +113,276 @@ class MockOpenAI:
 
     def __init__(self) -> None:
         self.images = MockImages()
-        self.chat = MockChatCompletions()
+        self.chat = MockChat()
+        self.closed = False
+
+    async def close(self) -> None:
+        """Mock close method"""
+        self.closed = True
+
+
+@pytest.fixture(autouse=True)
+def empty_prompt_cache() -> None:
+    """Fixture to make sure cached prompts don't leak between tests"""
+    ai_service.prompt_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def mock_http_client(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Fixture to serve generated image downloads without hitting the network"""
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, content=b"test image bytes")
 
+    monkeypatch.setattr(
+        ai_service,
+        "http_client",
+        httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+    )
 
-@pytest.fixture
-def mock_openai_client(monkeypatch: pytest.MonkeyPatch) -> MockOpenAI:
-    """Fixture to mock the OpenAI client"""
-    # Replace the client with our mock
-    monkeypatch.setattr(ai_service, "client", MockOpenAI())
+
+@pytest.fixture(scope="session")
+def mock_openai() -> MockOpenAI:
+    """Fixture to build the mock OpenAI client once for the whole session"""
     return MockOpenAI()
 
 
-@pytest.mark.asyncio
-async def test_generate_profile_images(mock_openai_client: MockOpenAI) -> None:
-    """Test that the AI service generates the expected number of images"""
-    # Create mock image data
-    mock_image = BytesIO(b"test image data")
+@pytest.fixture(autouse=True)
+def mock_openai_client(
+    monkeypatch: pytest.MonkeyPatch, mock_openai: MockOpenAI
+) -> None:
+    """Fixture to replace the OpenAI client with the mock for every test"""
+    monkeypatch.setattr(ai_service, "client", mock_openai)
 
+
+@pytest.mark.parametrize("num_variants", [1, 4, 10])
+async def test_generate_profile_images(num_variants: int) -> None:
+    """Test that the AI service generates the expected number of images"""
     # Call the function
-    result = await generate_profile_images(mock_image, num_variants=4)
+    result = await generate_profile_images(MOCK_IMAGE, num_variants=num_variants)
 
     # Check that it returns the expected number of results
-    assert len(result) == 4
+    assert len(result) == num_variants
     # All should be bytes objects
-    assert all(isinstance(img, bytes) for img in result)
-
-
-@pytest.mark.asyncio
-async def test_analyze_image_with_gpt4o(monkeypatch: pytest.MonkeyPatch) -> None:
+    assert all(type(img) is bytes for img in result)
+
+
+async def test_generate_profile_images_caches_prompts(
+    monkeypatch: pytest.MonkeyPatch, mock_openai: MockOpenAI
+) -> None:
+    """Test that re-uploading the same image skips the GPT-4o analysis"""
+    completions = mock_openai.chat.completions
+    monkeypatch.setattr(completions, "calls", 0)
+
+    await generate_profile_images(MOCK_IMAGE, num_variants=2)
+    await generate_profile_images(MOCK_IMAGE, num_variants=2)
+    assert completions.calls == 1
+
+    # A different image or number of variants needs a fresh analysis
+    await generate_profile_images(b"other image data", num_variants=2)
+    await generate_profile_images(MOCK_IMAGE, num_variants=3)
+    assert completions.calls == 3
+
+
+async def test_generate_profile_images_concurrently(
+    monkeypatch: pytest.MonkeyPatch, mock_openai: MockOpenAI
+) -> None:
+    """Test that the DALL-E variants are requested concurrently"""
+    tracker = InFlightTracker(expected=4)
+    monkeypatch.setattr(mock_openai, "images", ConcurrencyTrackingImages(tracker))
+
+    result = await generate_profile_images(MOCK_IMAGE, num_variants=4)
+
+    # A timed-out call would show up as an empty placeholder
+    assert result == [b"test image bytes"] * 4
+    # All four requests should have been in flight at the same time
+    assert tracker.max_in_flight == 4
+
+
+async def test_generate_profile_images_respects_concurrency_cap(
+    monkeypatch: pytest.MonkeyPatch, mock_openai: MockOpenAI
+) -> None:
+    """Test that no more than the allowed number of OpenAI calls run at once"""
+    # More calls than the cap, so the tracker never releases them on its own
+    tracker = InFlightTracker(expected=4)
+    monkeypatch.setattr(mock_openai, "images", ConcurrencyTrackingImages(tracker))
+    monkeypatch.setattr(ai_service, "openai_semaphore", asyncio.Semaphore(2))
+
+    task = asyncio.create_task(generate_profile_images(MOCK_IMAGE, num_variants=4))
+    # Wait for the first calls to start, give any others a chance to join them,
+    # then let them all finish
+    async with asyncio.timeout(1):
+        while tracker.in_flight < 2:
+            await asyncio.sleep(0.01)
+    await asyncio.sleep(0.05)
+    tracker.release.set()
+    result = await task
+
+    assert result == [b"test image bytes"] * 4
+    assert tracker.max_in_flight == 2
+
+
+async def test_analyze_image_with_gpt4o_does_not_block(
+    monkeypatch: pytest.MonkeyPatch, mock_openai: MockOpenAI
+) -> None:
+    """Test that concurrent analyses don't block each other on the event loop"""
+    tracker = InFlightTracker(expected=2)
+    monkeypatch.setattr(
+        mock_openai.chat, "completions", ConcurrencyTrackingChatCompletions(tracker)
+    )
+
+    results = await asyncio.gather(
+        ai_service.analyze_image_with_gpt4o(b"test image 1", num_variants=2),
+        ai_service.analyze_image_with_gpt4o(b"test image 2", num_variants=2),
+    )
+
+    assert all(len(prompts) == 2 for prompts in results)
+    # Both GPT-4o calls should have been awaited at the same time
+    assert tracker.max_in_flight == 2
+
+
+async def test_analyze_image_with_gpt4o() -> None:
     """Test that the image analysis returns expected prompts"""
-    # Set up a mock
-    mock_client = MockOpenAI()
+    # Call the function
+    prompts = await ai_service.analyze_image_with_gpt4o(MOCK_IMAGE, num_variants=4)
 
-    # Create test image data
-    image_data = BytesIO(b"test image data")
+    # Verify we get the prompts from the GPT-4o response
+    assert prompts == MOCK_PROMPTS
+    assert all(type(prompt) is str for prompt in prompts)
 
-    # Set the mock client
-    monkeypatch.setattr(ai_service, "client", mock_client)
 
+async def test_generate_image_with_dalle() -> None:
+    """Test that the image generation returns byte data"""
     # Call the function
-    prompts = await ai_service.analyze_image_with_gpt4o(image_data, num_variants=4)
+    image_bytes = await ai_service.generate_image_with_dalle("Test prompt")
 
-    # Verify we get the expected number of prompts
-    assert len(prompts) == 4
-    assert all(isinstance(prompt, str) for prompt in prompts)
+    # Verify we get the downloaded image back
+    assert image_bytes == b"test image bytes"
 
 
-@pytest.mark.asyncio
-async def test_generate_image_with_dalle(monkeypatch: pytest.MonkeyPatch) -> None:
-    """Test that the image generation returns byte data"""
-    # Set up a mock
-    mock_client = MockOpenAI()
+async def test_analyze_image_with_gpt4o_without_client(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """Test that dummy prompts are returned without processing the image"""
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    monkeypatch.setattr(ai_service, "client", None)
 
-    # Set the mock client
-    monkeypatch.setattr(ai_service, "client", mock_client)
+    def fail_prepare(image_bytes: bytes) -> bytes:
+        raise AssertionError("The image should not be processed")
 
-    # Call the function
-    image_bytes = await ai_service.generate_image_with_dalle("Test prompt")
+    monkeypatch.setattr(ai_service, "_prepare_image_for_analysis", fail_prepare)
+
+    prompts = await ai_service.analyze_image_with_gpt4o(MOCK_IMAGE, 3)
+
+    assert len(prompts) == 3
+
+
+async def test_call_openai_retries_transient_errors(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """Test that rate limit errors are retried until the call succeeds"""
+    monkeypatch.setattr(ai_service, "openai_retry_wait", wait_none())
+    calls = 0
+
+    async def flaky_request() -> str:
+        nonlocal calls
+        calls += 1
+        if calls < 3:
+            raise RateLimitError(
+                "Rate limited",
+                response=httpx.Response(
+                    429, request=httpx.Request("POST", "https://api.openai.com")
+                ),
+                body=None,
+            )
+        return "done"
+
+    assert await ai_service.call_openai(flaky_request) == "done"
+    assert calls == 3
+
+
+async def test_call_openai_does_not_retry_other_errors(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """Test that non-transient errors are raised without retrying"""
+    monkeypatch.setattr(ai_service, "openai_retry_wait", wait_none())
+    calls = 0
+
+    async def failing_request() -> str:
+        nonlocal calls
+        calls += 1
+        raise ValueError("Bad request")
+
+    with pytest.raises(ValueError):
+        await ai_service.call_openai(failing_request)
+    assert calls == 1
+
+
+async def test_get_client_lazily(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that the OpenAI client is only created once it's needed"""
+    monkeypatch.setattr(ai_service, "client", None)
+    monkeypatch.setattr(ai_service, "http_client", None)
+
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    assert ai_service.get_client() is None
+
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+    openai_client = ai_service.get_client()
+    assert openai_client is not None
+    assert ai_service.get_client() is openai_client
+    assert ai_service.http_client is not None
+
+    # Release the real client's connections before monkeypatch restores the mock
+    await ai_service.close_client()
+    assert ai_service.client is None
+    assert ai_service.http_client is None
+
+
+async def test_close_client(
+    monkeypatch: pytest.MonkeyPatch, mock_openai: MockOpenAI
+) -> None:
+    """Test that closing the client releases its connections"""
+    monkeypatch.setattr(mock_openai, "closed", False)
+
+    await ai_service.close_client()
+
+    assert mock_openai.closed
+    assert ai_service.client is None
+
+
+def test_prepare_image_for_analysis_downscales() -> None:
+    """Test that large uploads are shrunk to a JPEG before analysis"""
+    buffer = BytesIO()
+    Image.new("RGBA", (3000, 2000), "red").save(buffer, "PNG")
+
+    prepared = ai_service._prepare_image_for_analysis(buffer.getvalue())  # type: ignore
+
+    with Image.open(BytesIO(prepared)) as image:
+        assert image.format == "JPEG"
+        assert image.size == (1024, 683)
+
+
+def test_prepare_image_for_analysis_undecodable() -> None:
+    """Test that images Pillow can't read are passed through unchanged"""
+    prepared = ai_service._prepare_image_for_analysis(MOCK_IMAGE)  # type: ignore
+
+    assert prepared == MOCK_IMAGE
+
+
+def test_prepare_image_for_analysis_too_many_pixels(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """Test that images with huge dimensions are passed through without decoding"""
+    buffer = BytesIO()
+    Image.new("RGB", (200, 100), "red").save(buffer, "PNG")
+    image_bytes = buffer.getvalue()
+
+    monkeypatch.setattr(ai_service, "ANALYSIS_IMAGE_MAX_PIXELS", 10_000)
+    prepared = ai_service._prepare_image_for_analysis(image_bytes)  # type: ignore
+    assert prepared == image_bytes
 
-    # Verify we get bytes back
-    assert isinstance(image_bytes, bytes)
+    # Pillow refuses to open images far beyond its own limit
+    monkeypatch.setattr(ai_service, "ANALYSIS_IMAGE_MAX_PIXELS", 1_000_000)
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 5_000)
+    prepared = ai_service._prepare_image_for_analysis(image_bytes)  # type: ignore
+    assert prepared == image_bytes
@@ -1,19 +1,48 @@
+import base64
+from io import BytesIO
+
 import pytest
+from fastapi import HTTPException, UploadFile
 from fastapi.testclient import TestClient
+from starlette.datastructures import Headers
+
+from profileinator import ai_service, main
+
+# Dummy uploads for testing, built once for the whole module
+TEST_PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 100  # Simple PNG header + content
+TEST_TEXT = b"not an image"
 
-from profileinator import ai_service
-from profileinator.main import app
+MULTIPART_BOUNDARY = "profileinator-test-boundary"
 
-client = TestClient(app)
+
+def _multipart_upload(
+    filename: str, data: bytes, content_type: str
+) -> tuple[bytes, dict[str, str]]:
+    """Build a multipart/form-data body and headers for an `image` upload"""
+    part_headers = (
+        f"--{MULTIPART_BOUNDARY}\r\n"
+        f'Content-Disposition: form-data; name="image"; filename="{filename}"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    )
+    closing = f"\r\n--{MULTIPART_BOUNDARY}--\r\n"
+    body = part_headers.encode() + data + closing.encode()
+    headers = {"Content-Type": f"multipart/form-data; boundary={MULTIPART_BOUNDARY}"}
+    return body, headers
+
+
+# Encoded once so each test posts the same pre-built bytes
+PNG_BODY, PNG_HEADERS = _multipart_upload("test.png", TEST_PNG, "image/png")
+TEXT_BODY, TEXT_HEADERS = _multipart_upload("test.txt", TEST_TEXT, "text/plain")
 
 
 @pytest.fixture(autouse=True)
 def no_client(monkeypatch: pytest.MonkeyPatch):
     """Fixture to ensure we don't hit OpenAI"""
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
     monkeypatch.setattr(ai_service, "client", None)
 
 
-def test_read_root():
+def test_read_root(client: TestClient):
     """Test that the root endpoint returns the index.html page"""
     response = client.get("/")
     assert response.status_code == 200
@@ -21,32 +50,109 @@ def test_read_root():
     assert "Profileinator" in response.text
 
 
-def test_generate_profiles_invalid_file():
+def test_generate_profiles_invalid_file(client: TestClient):
     """Test that the generate endpoint rejects non-image files"""
     response = client.post(
         "/generate/",
-        files={"image": ("test.txt", b"not an image", "text/plain")},
+        content=TEXT_BODY,
+        headers=TEXT_HEADERS,
         params={"num_variants": 5},
     )
     assert response.status_code == 400
     assert response.json()["detail"] == "File must be an image"
 
 
-def test_generate_profiles_valid_image(monkeypatch: pytest.MonkeyPatch):
+def test_generate_profiles_too_large(
+    client: TestClient, monkeypatch: pytest.MonkeyPatch
+):
+    """Test that the generate endpoint rejects oversized uploads"""
+    monkeypatch.setattr(main, "MAX_UPLOAD_BYTES", 50)
+
+    response = client.post(
+        "/generate/",
+        content=PNG_BODY,
+        headers=PNG_HEADERS,
+        params={"num_variants": 5},
+    )
+    assert response.status_code == 413
+    assert response.json()["detail"] == "Image must be at most 50 bytes"
+
+
+async def test_generate_profiles_too_large_unknown_size(
+    monkeypatch: pytest.MonkeyPatch,
+):
+    """Test that oversized uploads are rejected even if their size isn't known up front"""
+    monkeypatch.setattr(main, "MAX_UPLOAD_BYTES", 50)
+    upload = UploadFile(
+        BytesIO(TEST_PNG),
+        filename="test.png",
+        headers=Headers({"content-type": "image/png"}),
+    )
+
+    with pytest.raises(HTTPException) as exc_info:
+        await main.generate_profiles(upload, num_variants=5)
+
+    assert exc_info.value.status_code == 413
+    assert exc_info.value.detail == "Image must be at most 50 bytes"
+
+
+def test_generate_profiles_valid_image(
+    client: TestClient, monkeypatch: pytest.MonkeyPatch
+):
     """Test that the generate endpoint accepts valid image files"""
     monkeypatch.delenv("OPENAI_API_KEY", raising=False)
-    # Create a dummy image file for testing
-    test_image = b"\x89PNG\r\n\x1a\n" + b"\x00" * 100  # Simple PNG header + content
 
     response = client.post(
         "/generate/",
-        files={"image": ("test.png", test_image, "image/png")},
+        content=PNG_BODY,
+        headers=PNG_HEADERS,
         params={"num_variants": 5},
     )
     assert response.status_code == 200
     assert "images" in response.json()
     assert isinstance(response.json()["images"], list)
     assert len(response.json()["images"]) > 0
-    assert all(isinstance(img, str) for img in response.json()["images"])
+    assert all(type(img) is str for img in response.json()["images"])
     assert "original_filename" in response.json()
     assert response.json()["original_filename"] == "test.png"
+
+
+def test_generate_profiles_image_urls(client: TestClient):
+    """Test that the generated images can be fetched from the returned URLs"""
+    response = client.post(
+        "/generate/",
+        content=PNG_BODY,
+        headers=PNG_HEADERS,
+        params={"num_variants": 2},
+    )
+    assert response.status_code == 200
+    urls = response.json()["images"]
+    assert len(urls) == 2
+
+    for url in urls:
+        image_response = client.get(url)
+        assert image_response.status_code == 200
+        assert image_response.headers["content-type"] == "image/png"
+        assert image_response.content == b"placeholder"
+
+
+def test_generate_profiles_inline(client: TestClient):
+    """Test that the generate endpoint can return base64-encoded images"""
+    response = client.post(
+        "/generate/",
+        content=PNG_BODY,
+        headers=PNG_HEADERS,
+        params={"num_variants": 2, "inline": True},
+    )
+    assert response.status_code == 200
+    assert (
+        response.json()["images"]
+        == [base64.b64encode(b"placeholder").decode("ascii")] * 2
+    )
+
+
+def test_get_image_not_found(client: TestClient):
+    """Test that unknown or expired images return a 404"""
+    response = client.get("/images/does-not-exist/0")
+    assert response.status_code == 404
+    assert response.json()["detail"] == "Image not found"